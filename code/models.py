@@ -10,11 +10,10 @@ from collections import defaultdict
 import copy
 import math
 
-from functools import reduce
-
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from transformers import AutoModel
 
 
@@ -22,45 +21,63 @@ def sequence_mask(lengths, max_len=None):
     """
     Creates a boolean mask from sequence lengths.
     """
-    batch_size = lengths.numel()
     max_len = max_len or lengths.max()
-    return (torch.arange(0, max_len, device=lengths.device)
-            .type_as(lengths)
-            .repeat(batch_size, 1)
-            .lt(lengths.unsqueeze(1)))
+    return torch.arange(0, max_len, device=lengths.device, dtype=lengths.dtype) < lengths.unsqueeze(1)
 
 def get_full_attention_mask(input_ids):
     return input_ids != 0
 
+
+def get_additive_mask(mask, dtype=torch.float):
+    """
+    Converts a boolean mask (True means attend) into an additive mask of 0/-inf.
+    """
+    return torch.zeros_like(mask, dtype=dtype).masked_fill_(~mask, float('-inf'))
+
     
-def get_attention_mask(adj_masks, node_pos, input_ids, text_len):
+def get_attention_mask(adj_masks, node_pos, input_ids, text_len, nonpad=None):
     bsz, seq_len = input_ids.shape
-    attention_mask = torch.zeros(bsz, seq_len, seq_len).to(adj_masks)
+    if nonpad is None:
+        nonpad = input_ids != 0
+    attention_mask = torch.zeros(bsz, seq_len, seq_len, dtype=torch.bool, device=input_ids.device)
     attention_mask[:, :text_len, :] = True # text may attend to everything
     attention_mask[:, :, :text_len] = True # everything may attend to text
-    attention_mask[:, torch.arange(seq_len), torch.arange(seq_len)] = True # everything may attend to itself
+    attention_mask.diagonal(dim1=-2, dim2=-1).fill_(True) # everything may attend to itself
+
+    # nothing may attend to or from pad
+    attention_mask &= nonpad.unsqueeze(1) & nonpad.unsqueeze(2)
+
+    # node spans as [bsz, max_nodes] start/end offsets, padded nodes get an empty span
+    max_nodes = adj_masks.size(-1)
+    spans = torch.zeros(bsz, max_nodes, 2, dtype=torch.long)
+    for idx_b, node_pos_b in enumerate(node_pos):
+        if node_pos_b:
+            spans[idx_b, :len(node_pos_b)] = torch.tensor(node_pos_b[:max_nodes])
+    starts, ends = (spans.to(input_ids.device) + text_len).unbind(dim=-1)
+
+    # adjacent nodes (b, u, v) may attend to each other: fill the rectangle
+    # start_u:end_u x start_v:end_v of every edge with a single index_fill_
+    idx_b, idx_u, idx_v = torch.nonzero(adj_masks).unbind(dim=-1)
+    start_u, start_v = starts[idx_b, idx_u], starts[idx_b, idx_v]
+    len_u, len_v = ends[idx_b, idx_u] - start_u, ends[idx_b, idx_v] - start_v
+    sizes = len_u * len_v
+    # edge of each cell and offset of the cell inside its rectangle
+    idx_e = torch.repeat_interleave(sizes)
+    offsets = torch.arange(idx_e.numel(), device=input_ids.device) - (sizes.cumsum(dim=0) - sizes)[idx_e]
+    rows = start_u[idx_e] + offsets // len_v[idx_e]
+    cols = start_v[idx_e] + offsets % len_v[idx_e]
+    attention_mask.view(-1).index_fill_(0, (idx_b[idx_e] * seq_len + rows) * seq_len + cols, True)
 
-    pad_idcs = torch.where(input_ids == 0)
-    for idx_b, idx_pad in zip(*pad_idcs): # nothing may attend to or from pad
-        attention_mask[idx_b, idx_pad, :] = False
-        attention_mask[idx_b, :, idx_pad] = False
+    return attention_mask
 
-    for idx_b, idx_u, idx_v in zip(*torch.where(adj_masks)):
-        node_pos_b = node_pos[idx_b]
-        if idx_u >= len(node_pos_b) or idx_v >= len(node_pos_b):
-            continue
 
-        start_u, end_u = node_pos_b[idx_u]
-        start_v, end_v = node_pos_b[idx_v]
-        
-        start_u += text_len
-        end_u += text_len
-        start_v += text_len
-        end_v += text_len
-        attention_mask[idx_b, start_u:end_u, start_v:end_v] = True
-    
-    return attention_mask
 
+def autocast(args, device):
+    """
+    bfloat16 autocast on CUDA devices, enabled with --bf16
+    """
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16,
+                          enabled=args.bf16 and device.type == "cuda")
 
 
 def clones(module, N):
@@ -69,10 +86,10 @@ def clones(module, N):
 
 
 def gating(linear, keys, query):
-    query = query.unsqueeze(dim=1)
-    gates = torch.sigmoid((query * keys).sum(dim=-1))
+    # [bsz, num_keys, dim] x [bsz, dim, 1] -> [bsz, num_keys, 1]
+    gates = torch.sigmoid(torch.matmul(keys, query.unsqueeze(dim=-1)))
 
-    return gates.unsqueeze(dim=-1) * keys
+    return gates * keys
 
 
 class GraphTrans(nn.Module):
@@ -95,6 +112,9 @@ class GraphTrans(nn.Module):
         self.bert = AutoModel.from_pretrained("microsoft/BiomedNLP-PubMedBERT-base-uncased-abstract-fulltext")
         self.node_embeds = Embeddings(self.args.encoder_embed_dim, len(node_dict))
         self.edge_embeds = self.node_embeds
+        # every node is adjacent to itself, sliced to the number of nodes in encoder
+        max_nodes = self.bert.config.max_position_embeddings
+        self.register_buffer("self_loops", torch.eye(max_nodes, dtype=torch.bool), persistent=False)
 
         # graph decoder
         self.graph_dec = Decoder(args, node_dict, edge_dict, self.node_embeds)
@@ -117,13 +137,13 @@ class GraphTrans(nn.Module):
         # Loss over target nodes
         bsz, tgt_len = nodes.size()
         nodes = nodes.contiguous().view(bsz*tgt_len)
-        node_outputs = node_outputs.view(bsz*tgt_len, -1)
+        node_outputs = node_outputs.view(bsz*tgt_len, -1).float()
         node_loss = self.node_xent(node_outputs, nodes)
 
         # Loss over target edge
         num_edge = edges.size(-1)
         edges = edges.contiguous().view(bsz*num_edge)
-        edge_outputs = edge_outputs.view(bsz*num_edge, -1)
+        edge_outputs = edge_outputs.view(bsz*num_edge, -1).float()
         edge_loss = self.edge_xent(edge_outputs, edges)
 
         sum_loss = node_loss + edge_loss
@@ -141,9 +161,8 @@ class GraphTrans(nn.Module):
         edge_embed = self.edge_embeds(src_graph["edges"])
         edge_masks = (src_graph["edges"] != self.edge_dict.pad()) * (src_graph["edges"] != self.edge_dict.index("<blank>"))
 
-        adj_masks = edge_masks.clone()
-        diag = torch.arange(adj_masks.size(-1))
-        adj_masks[:, diag, diag] = 1
+        num_nodes = edge_masks.size(-1)
+        adj_masks = edge_masks | self.self_loops[:num_nodes, :num_nodes]
 
         edge_embed *= edge_masks.unsqueeze(-1)
         # graph_embed = node_embed + edge_embed.sum(dim=2)
@@ -162,14 +181,17 @@ class GraphTrans(nn.Module):
             text_and_graph_encodings[k] = v
 
         text_and_graph_encodings["token_type_ids"][:, text_len:] = 1
+        # non-pad tokens, shared by the attention mask and the memory mask
+        nonpad_mask = text_and_graph_encodings["input_ids"] != 0
         text_and_graph_encodings["attention_mask"] = get_attention_mask(adj_masks=adj_masks, node_pos=src_graph["node_pos"],
                                                                         input_ids=text_and_graph_encodings["input_ids"],
-                                                                        text_len=text_len)
-        enc_repr = self.bert(input_ids=text_and_graph_encodings["input_ids"],
-            attention_mask=text_and_graph_encodings["attention_mask"],
-            token_type_ids=text_and_graph_encodings["token_type_ids"]
-        )
-        mem_masks = text_and_graph_encodings["input_ids"] != 0
+                                                                        text_len=text_len, nonpad=nonpad_mask)
+        with autocast(self.args, text_and_graph_encodings["input_ids"].device):
+            enc_repr = self.bert(input_ids=text_and_graph_encodings["input_ids"],
+                attention_mask=text_and_graph_encodings["attention_mask"],
+                token_type_ids=text_and_graph_encodings["token_type_ids"]
+            )
+        mem_masks = get_additive_mask(nonpad_mask, enc_repr["last_hidden_state"].dtype)
 
         enc_info = {"mem": enc_repr["last_hidden_state"], "mem_masks": mem_masks}
 
@@ -191,10 +213,17 @@ class Encoder(nn.Module):
     def __init__(self, layer, N):
         super().__init__()
         self.layers = clones(layer, N)
+        # Compile whole layers so the pre-norm, dropout and residual add of both
+        # sublayers fuse; the sublayer lambda keeps SublayerConnection from being
+        # a useful compile boundary on its own. Compilation happens on first call.
+        for l in self.layers:
+            l.compile(dynamic=True)
         self.norm = LayerNorm(layer.size)
         
     def forward(self, x, mask):
         "Pass the input (and mask) through each layer in turn."
+        if mask is not None:
+            mask = get_additive_mask(mask != 0, x.dtype)
         for layer in self.layers:
             x = layer(x, mask)
         return self.norm(x)
@@ -210,9 +239,7 @@ class LayerNorm(nn.Module):
         self.eps = eps
 
     def forward(self, x):
-        mean = x.mean(-1, keepdim=True)
-        std = x.std(-1, keepdim=True)
-        return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
+        return F.layer_norm(x, self.a_2.shape, self.a_2, self.b_2, self.eps)
 
 
 # Modified from http://nlp.seas.harvard.edu/2018/04/03/attention.html
@@ -247,20 +274,6 @@ class EncoderLayer(nn.Module):
         return self.sublayer[1](x, self.feed_forward)
 
 
-# Modified from http://nlp.seas.harvard.edu/2018/04/03/attention.html
-def attention(query, key, value, mask=None, dropout=None):
-    "Compute 'Scaled Dot Product Attention'"
-    d_k = query.size(-1)
-    scores = torch.matmul(query, key.transpose(-2, -1)) \
-             / math.sqrt(d_k)
-    if mask is not None:
-        scores = scores.masked_fill(mask == 0, -1e9)
-    p_attn = F.softmax(scores, dim = -1)
-    if dropout is not None:
-        p_attn = dropout(p_attn)
-    return torch.matmul(p_attn, value), p_attn
-
-
 # Modified from http://nlp.seas.harvard.edu/2018/04/03/attention.html
 class MultiHeadedAttention(nn.Module):
     def __init__(self, h, d_model, dropout=0.1):
@@ -270,30 +283,41 @@ class MultiHeadedAttention(nn.Module):
         # We assume d_v always equals d_k
         self.d_k = d_model // h
         self.h = h
-        self.linears = clones(nn.Linear(d_model, d_model), 4)
-        self.attn = None
+        linear = nn.Linear(d_model, d_model)
+        # Q, K and V projections fused into one linear layer, initialised
+        # identically to the output projection
+        self.qkv = nn.Linear(d_model, 3 * d_model)
+        with torch.no_grad():
+            self.qkv.weight.copy_(linear.weight.repeat(3, 1))
+            self.qkv.bias.copy_(linear.bias.repeat(3))
+        self.out = linear
         self.dropout = nn.Dropout(p=dropout)
         
     def forward(self, query, key, value, mask=None):
         "Implements Figure 2"
         if mask is not None:
-            # Same mask applied to all h heads.
+            # Same additive mask applied to all h heads.
             mask = mask.unsqueeze(1)
         nbatches = query.size(0)
         
         # 1) Do all the linear projections in batch from d_model => h x d_k 
-        query, key, value = \
-            [l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
-             for l, x in zip(self.linears, (query, key, value))]
+        if query is key and key is value:
+            # Self-attention: a single GEMM for Q, K and V
+            query, key, value = self.qkv(query) \
+                .view(nbatches, -1, 3, self.h, self.d_k).permute(2, 0, 3, 1, 4)
+        else:
+            query, key, value = \
+                [F.linear(x, w, b).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
+                 for x, w, b in zip((query, key, value), self.qkv.weight.chunk(3), self.qkv.bias.chunk(3))]
         
-        # 2) Apply attention on all the projected vectors in batch. 
-        x, self.attn = attention(query, key, value, mask=mask, 
-                                 dropout=self.dropout)
+        # 2) Apply fused scaled dot product attention on all the projected vectors in batch.
+        x = F.scaled_dot_product_attention(query, key, value, attn_mask=mask,
+                                           dropout_p=self.dropout.p if self.training else 0.0)
         
         # 3) "Concat" using a view and apply a final linear. 
         x = x.transpose(1, 2).contiguous() \
              .view(nbatches, -1, self.h * self.d_k)
-        return self.linears[-1](x)
+        return self.out(x)
 
 
 # Modified from http://nlp.seas.harvard.edu/2018/04/03/attention.html
@@ -314,11 +338,24 @@ class Embeddings(nn.Module):
     def __init__(self, d_model, vocab):
         super().__init__()
         self.lut = nn.Embedding(vocab, d_model)
+        # output projection sharing its weight with lut
+        self.proj = nn.Linear(d_model, vocab, bias=False)
+        self.proj.weight = self.lut.weight
         self.d_model = d_model
 
     def forward(self, x):
         return self.lut(x) * math.sqrt(self.d_model)
 
+    def project(self, x):
+        "Output projection tied to the embedding matrix."
+        return self.proj(x)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the tied proj only store lut.weight
+        if prefix + "lut.weight" in state_dict:
+            state_dict.setdefault(prefix + "proj.weight", state_dict[prefix + "lut.weight"])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 
 # Modified from http://nlp.seas.harvard.edu/2018/04/03/attention.html
 class PositionalEncoding(nn.Module):
@@ -338,7 +375,8 @@ class PositionalEncoding(nn.Module):
         self.register_buffer('pe', pe)
         
     def forward(self, x):
-        x = x + self.pe[:, :x.size(1)]
+        # cast only the used slice to the input dtype, e.g. under autocast
+        x = x + self.pe[:, :x.size(1)].to(x.dtype)
 
         return self.dropout(x)
 
@@ -346,40 +384,67 @@ class PositionalEncoding(nn.Module):
 class Attention(nn.Module):
     """
     Luong's attention
+
+    score_type: "additive" for v(tanh(Wq + Uh)), "dot" for scaled (Wq)(Uh)^T
+    chunk_size: number of target steps scored at once by the additive score,
+                bounds the [bsz, steps, src_len, dim] intermediate
+    checkpoint_chunks: recompute tanh(Wq + Uh) of each chunk in backward
+                       instead of keeping it alive
     """
-    def __init__(self, input_size, mem_size):
+    def __init__(self, input_size, mem_size, score_type="additive", chunk_size=16, checkpoint_chunks=False):
         super().__init__()
         self.dim = mem_size
+        self.score_type = score_type
+        self.chunk_size = chunk_size
+        self.checkpoint_chunks = checkpoint_chunks
         self.linear_q = nn.Linear(input_size, mem_size, bias=False)
         self.linear_c = nn.Linear(mem_size, mem_size, bias=True)
         self.v = nn.Linear(mem_size, 1, bias=False)
         self.linear_out = nn.Linear(mem_size+input_size, input_size, bias=True)
 
-    def score(self, q, m):
-        src_batch, src_len, src_dim = m.size()
-        tgt_batch, tgt_len, tgt_dim = q.size() 
+    def project_mems(self, m):
+        "Memory projection, independent of the queries and reusable across decoding steps."
+        return self.linear_c(m)
+
+    def additive_score(self, wq, uh):
+        "v(tanh(wq + uh)) for wq: [bsz, tgt_len, dim] and uh: [bsz, src_len, dim]"
+        return self.v(torch.tanh(wq.unsqueeze(2) + uh.unsqueeze(1))).squeeze(-1)
+
+    def dot_score(self, wq, uh):
+        "Scaled dot product of wq: [bsz, tgt_len, dim] and uh: [bsz, src_len, dim] as a single bmm"
+        return torch.bmm(wq, uh.transpose(1, 2)) / math.sqrt(self.dim)
 
-        bsz = src_batch
-        dim = self.dim
+    def score(self, q, m, uh=None):
+        wq = self.linear_q(q)
+        if uh is None:
+            uh = self.project_mems(m)
 
-        wq = self.linear_q(q).view(bsz, tgt_len, 1, dim).expand(bsz, tgt_len, src_len, dim)
-        uh = self.linear_c(m).view(bsz, 1, src_len, dim).expand(bsz, tgt_len, src_len, dim)
+        if self.score_type == "dot":
+            return self.dot_score(wq, uh)
 
-        wquh = torch.tanh(wq + uh)
+        if not torch.is_grad_enabled():
+            # chunks only bound the transient intermediate, nothing is kept for backward
+            return torch.cat([self.additive_score(wq_chunk, uh)
+                              for wq_chunk in wq.split(self.chunk_size, dim=1)], dim=1)
+        if self.checkpoint_chunks and wq.size(1) > self.chunk_size:
+            return torch.cat([checkpoint(self.additive_score, wq_chunk, uh, use_reentrant=False)
+                              for wq_chunk in wq.split(self.chunk_size, dim=1)], dim=1)
 
-        return self.v(wquh).view(bsz, tgt_len, src_len)
+        return self.additive_score(wq, uh)
 
-    def forward(self, inputs, mems, mem_masks=None):
+    def forward(self, inputs, mems, mem_masks=None, mem_proj=None):
         
-        align = self.score(inputs, mems)
+        align = self.score(inputs, mems, mem_proj)
 
         if mem_masks is not None:
             if mem_masks.dim() == 1:
-                mask = sequence_mask(mem_masks, max_len=align.size(-1))
+                mask = get_additive_mask(sequence_mask(mem_masks, max_len=align.size(-1)), align.dtype)
+            elif mem_masks.dtype == torch.bool:
+                mask = get_additive_mask(mem_masks, align.dtype)
             else:
-                mask = mem_masks
+                mask = mem_masks  # Already additive, see GraphTrans.encoder
             mask = mask.unsqueeze(1)  # Make it broadcastable.
-            align.masked_fill_(~mask, -float('inf'))
+            align = align + mask
 
         align_vectors = F.softmax(align, -1)
 
@@ -405,9 +470,11 @@ class Decoder(nn.Module):
         node_types = len(node_dict)
         # self.node_embeds = nn.Embedding(node_types, args.node_embed_size, padding_idx=node_dict.pad())
         self.node_embeds = embeds
-        self.node_RNN = nn.GRU(args.node_embed_size, args.node_hidden_size, batch_first=True,
+        # RNNs run time-major ([len, bsz, dim]), the rest of the decoder stays batch-major
+        self.node_RNN = nn.GRU(args.node_embed_size, args.node_hidden_size, batch_first=False,
                                num_layers=args.dec_layers, dropout=args.dropout)
-        self.node_att = Attention(args.node_hidden_size, args.encoder_embed_dim)
+        self.node_att = Attention(args.node_hidden_size, args.encoder_embed_dim, args.attention_score,
+                                  checkpoint_chunks=args.attention_checkpoint)
         # self.node_out_proj = nn.Linear(args.node_hidden_size, node_types)
         if args.node_embed_size != args.encoder_embed_dim:
             self.node_input_proj = nn.Linear(args.encoder_embed_dim, args.node_embed_size)
@@ -422,9 +489,10 @@ class Decoder(nn.Module):
         edge_types = len(edge_dict)
         # self.edge_embeds = nn.Embedding(edge_types, args.edge_embed_size, padding_idx=edge_dict.pad())
         self.edge_embeds = embeds
-        self.edge_RNN = nn.GRU(args.edge_embed_size+args.node_hidden_size*2, args.edge_hidden_size, batch_first=True,
+        self.edge_RNN = nn.GRU(args.edge_embed_size+args.node_hidden_size*2, args.edge_hidden_size, batch_first=False,
                                num_layers=args.dec_layers, dropout=args.dropout)
-        self.edge_att = Attention(args.edge_hidden_size, args.encoder_embed_dim)
+        self.edge_att = Attention(args.edge_hidden_size, args.encoder_embed_dim, args.attention_score,
+                                  checkpoint_chunks=args.attention_checkpoint)
         # self.edge_out_proj = nn.Linear(args.edge_hidden_size, edge_types)
         if args.edge_embed_size != args.encoder_embed_dim:
             self.edge_input_proj = nn.Linear(args.encoder_embed_dim, args.edge_embed_size)
@@ -435,31 +503,56 @@ class Decoder(nn.Module):
         else:
             self.edge_out_proj = None
 
+        # cache of (src_nodes_indices, tgt_nodes_indices) per node size and device
+        self._edge_indices = {}
+
+    def edge_indices(self, node_size, device):
+        """
+        Indices of source and target nodes of edges of target graphs
+
+        Edges of the lower triangle are visited row by row, followed by the
+        edge of the final (eos) step.
+        """
+        key = (node_size, device)
+        if key not in self._edge_indices:
+            num_nodes = max(node_size-1, 0)
+            src_nodes_indices, tgt_nodes_indices = torch.tril_indices(num_nodes, num_nodes, offset=-1, device=device)
+            last = src_nodes_indices.new_full((1,), node_size-1 if node_size > 2 else 0)
+            self._edge_indices[key] = (torch.cat([src_nodes_indices, last]), torch.cat([tgt_nodes_indices, last]))
+
+        return self._edge_indices[key]
+
     def node_forward(self, enc_info, nodes, nodes_len, init_hiddens=None):
         """node-level generation
 
         enc_info: hidden states of source graphs and source queries
         nodes: ground truths of target nodes: [bsz, len]
-        nodes_len: masks for target nodes: [bsz, len]
+        nodes_len: lengths of target nodes: [bsz]
         init_hiddens: initial hidden states for RNN
+
+        h is the hidden state after the last (possibly padded) step.
         """
         bsz, steps = nodes.size()
         nodes_embeds = self.node_embeds(nodes)
         if self.node_input_proj:
             nodes_embeds = self.node_input_proj(nodes_embeds)
 
-        padded_nodes_embeds = nn.utils.rnn.pack_padded_sequence(nodes_embeds, nodes_len.cpu(), batch_first=True)
-        rnn_packed_outputs, h = self.node_RNN(padded_nodes_embeds, init_hiddens)
-
-        rnn_outputs = nn.utils.rnn.pad_packed_sequence(rnn_packed_outputs, batch_first=True)[0]
-
-        context, _ = self.node_att(rnn_outputs, enc_info["mem"], enc_info["mem_masks"])
-        # outputs = self.node_out_proj(self.dropout(context))
-        if self.node_out_proj:
-            outputs = self.node_out_proj(context) 
-        else:
-            outputs = context
-        outputs = F.linear(self.dropout(outputs), self.node_embeds.lut.weight)
+        with autocast(self.args, nodes.device):
+            # run the GRU over the padded batch rather than packing it, which would need
+            # the lengths on the CPU; padding only trails, so outputs of real steps are unchanged
+            rnn_outputs, h = self.node_RNN(nodes_embeds.transpose(0, 1).contiguous(), init_hiddens)
+            rnn_outputs = rnn_outputs.transpose(0, 1)
+            rnn_outputs = rnn_outputs * sequence_mask(nodes_len, max_len=steps).unsqueeze(-1)
+
+            if "node_mem_proj" not in enc_info:
+                enc_info["node_mem_proj"] = self.node_att.project_mems(enc_info["mem"])
+            context, _ = self.node_att(rnn_outputs, enc_info["mem"], enc_info["mem_masks"], enc_info["node_mem_proj"])
+            # outputs = self.node_out_proj(self.dropout(context))
+            if self.node_out_proj:
+                outputs = self.node_out_proj(context) 
+            else:
+                outputs = context
+            outputs = self.node_embeds.project(self.dropout(outputs))
 
         return rnn_outputs, h, outputs
 
@@ -482,15 +575,19 @@ class Decoder(nn.Module):
         # rnn
         rnn_inputs = torch.cat([edges_embeds, src_nodes, tgt_nodes], dim=-1)
 
-        rnn_outputs, h = self.edge_RNN(rnn_inputs, init_hiddens)
+        with autocast(self.args, edges.device):
+            rnn_outputs, h = self.edge_RNN(rnn_inputs.transpose(0, 1).contiguous(), init_hiddens)
+            rnn_outputs = rnn_outputs.transpose(0, 1)
 
-        context, _ = self.edge_att(rnn_outputs, enc_info["mem"], enc_info["mem_masks"])
-        # outputs = self.edge_out_proj(self.dropout(context))
-        if self.edge_out_proj:
-            outputs = self.edge_out_proj(context) 
-        else:
-            outputs = context
-        outputs = F.linear(self.dropout(outputs), self.edge_embeds.lut.weight)
+            if "edge_mem_proj" not in enc_info:
+                enc_info["edge_mem_proj"] = self.edge_att.project_mems(enc_info["mem"])
+            context, _ = self.edge_att(rnn_outputs, enc_info["mem"], enc_info["mem_masks"], enc_info["edge_mem_proj"])
+            # outputs = self.edge_out_proj(self.dropout(context))
+            if self.edge_out_proj:
+                outputs = self.edge_out_proj(context) 
+            else:
+                outputs = context
+            outputs = self.edge_embeds.project(self.dropout(outputs))
 
         return rnn_outputs, h, outputs
 
@@ -503,16 +600,9 @@ class Decoder(nn.Module):
         node_rnn_outputs, _, node_outputs = self.node_forward(enc_info, nodes["x"], nodes_lens)
 
         node_size = node_rnn_outputs.size(1)
-        # build indices of source nodes of edges of target graphs
-        src_nodes_indices = reduce(lambda x, y: x+y, [[i for _ in range(i)] for i in range(1, node_size-1)]) if node_size > 2 else []
-        src_nodes_indices = src_nodes_indices + [src_nodes_indices[-1]+1] if src_nodes_indices else [0]
-        src_nodes_indices = torch.tensor(src_nodes_indices).to(node_rnn_outputs.device)
+        # indices of source and target nodes of edges of target graphs
+        src_nodes_indices, tgt_nodes_indices = self.edge_indices(node_size, node_rnn_outputs.device)
         src_nodes = torch.index_select(node_rnn_outputs, 1, src_nodes_indices)
-
-        # build indices of target nodes of edges of target graphs
-        tgt_nodes_indices = reduce(lambda x, y: x+y, [[j for j in range(i)] for i in range(1, node_size-1)]) if node_size > 2 else []
-        tgt_nodes_indices = tgt_nodes_indices + [src_nodes_indices[-1]] if tgt_nodes_indices else [0]
-        tgt_nodes_indices = torch.tensor(tgt_nodes_indices).to(node_rnn_outputs.device)
         tgt_nodes = torch.index_select(node_rnn_outputs, 1, tgt_nodes_indices)
 
         # edge-level decoder
@@ -107,10 +107,12 @@ def decoding(graph_dec, enc_info, node_dict, edge_dict, max_nodes, cuda):
 
 def greedy_search(model, src_graph, src_text, tgt_graph,
                   node_dict, edge_dict, max_nodes, cuda):
-    # graph encoder
-    enc_info = model.encoder(src_graph, src_text)
-    inputs, _, edges, _, src_nodes, tgt_nodes = decoding(model.graph_dec, enc_info,
-                                                         node_dict, edge_dict, max_nodes, cuda)
+    # no autograd state is needed for decoding
+    with torch.no_grad():
+        # graph encoder
+        enc_info = model.encoder(src_graph, src_text)
+        inputs, _, edges, _, src_nodes, tgt_nodes = decoding(model.graph_dec, enc_info,
+                                                             node_dict, edge_dict, max_nodes, cuda)
         
     node_c = Counter()
     act_outputs = [i.item() for i in tgt_graph["nodes"]["y"][0][:-1]]
@@ -182,6 +184,9 @@ def main():
     print(args)
 
     cuda = torch.cuda.is_available()
+    if args.bf16:
+        # let the remaining fp32 matmuls use TF32 tensor cores
+        torch.backends.cuda.matmul.allow_tf32 = True
 
     node_dict, edge_dict, text_dict = load_dict(args)
 
@@ -80,6 +80,9 @@ def main():
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
     cuda = torch.cuda.is_available()
+    if args.bf16:
+        # let the remaining fp32 matmuls use TF32 tensor cores
+        torch.backends.cuda.matmul.allow_tf32 = True
 
     node_dict, edge_dict, text_dict = load_dict(args)
 
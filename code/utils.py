@@ -26,10 +26,14 @@ def get_parser(stage="train"):
     parser.add_argument("--encoder-ffn-embed-dim", default=512, type=int)
     parser.add_argument("--encoder-layers", default=3, type=int)
     parser.add_argument("--dropout", default=0.1, type=float)
+    parser.add_argument("--bf16", action="store_true", help="run BERT and the decoder under bfloat16 autocast and allow TF32 matmuls on GPU")
     # decoder
     parser.add_argument("--node-embed-size", default=768, type=int)
     parser.add_argument("--node-hidden-size", default=768, type=int)
     parser.add_argument("--dec-layers", default=1, type=int)
+    parser.add_argument("--attention-score", default="additive", choices=["additive", "dot"])
+    parser.add_argument("--attention-checkpoint", action="store_true",
+                        help="recompute the additive attention scores in backward to save memory")
     parser.add_argument("--edge-embed-size", default=768, type=int)
     parser.add_argument("--edge-hidden-size", default=768, type=int)
 